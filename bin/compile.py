@@ -25,6 +25,11 @@ import sys
 import os
 import argparse
 import atexit
+import hashlib
+import importlib.util
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from command_runner import command_runner
 from ofunctions.platform import python_arch, get_os
 
@@ -85,30 +90,35 @@ def get_metadata(package_file):
     return _metadata
 
 
-def check_private_build(audience):
-    private = None
+def _find_spec(module):
     try:
-        import PRIVATE._private_secret_keys
-
-        print("INFO: Building with private secret key")
-        private = True
+        return importlib.util.find_spec(module)
     except ImportError:
-        try:
-            import npbackup.secret_keys
+        return None
 
-            print("INFO: Building with default secret key")
-            private = False
-        except ImportError:
-            print("ERROR: Cannot find secret keys")
-            sys.exit()
 
-    # Drop private files if exist in memory
-    try:
-        del PRIVATE._private_secret_keys
-    except Exception:
-        pass
+def check_private_build(audience):
+    private = None
+    # Run the secret key and conf dist probes concurrently, each one costs a
+    # directory scan which gets slow on cold cache or network filesystems
+    # find_spec only locates the modules without executing them, so no private
+    # data gets loaded in memory here
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        private_key_future = executor.submit(_find_spec, "PRIVATE._private_secret_keys")
+        public_key_future = executor.submit(_find_spec, "npbackup.secret_keys")
+        dist_conf_future = executor.submit(get_conf_dist_file, audience)
+
+    if private_key_future.result():
+        print("INFO: Building with private secret key")
+        private = True
+    elif public_key_future.result():
+        print("INFO: Building with default secret key")
+        private = False
+    else:
+        print("ERROR: Cannot find secret keys")
+        sys.exit()
 
-    dist_conf_file_path = get_conf_dist_file(audience)
+    dist_conf_file_path = dist_conf_future.result()
     if dist_conf_file_path and "_private" in dist_conf_file_path:
         print("INFO: Building with a private conf.dist file")
         if audience != "private":
@@ -162,6 +172,79 @@ def get_conf_dist_file(audience):
     return dist_conf_file_path
 
 
+def sha256sum(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(65536), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_build_manifest(sources):
+    """
+    Computes hashes of build input files so unchanged builds can be skipped
+    """
+    manifest = {}
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                if "__pycache__" in dirs:
+                    dirs.remove("__pycache__")
+                for file in files:
+                    if file.endswith(".pyc"):
+                        continue
+                    file_path = os.path.join(root, file)
+                    manifest[file_path] = sha256sum(file_path)
+        elif os.path.isfile(source):
+            manifest[source] = sha256sum(source)
+    return manifest
+
+
+def stage_file(source_file, staging_dir):
+    """
+    Copies a data file into the staging dir only when size or mtime changed,
+    so repeated builds don't redo identical file I/O
+    """
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    dest_file = os.path.join(staging_dir, os.path.basename(source_file))
+    # copy2 preserves mtime, so any mtime difference means the source changed
+    # (a < comparison would keep stale copies of sources reverted to an older
+    # version of the same size)
+    if (
+        not os.path.isfile(dest_file)
+        or os.path.getsize(dest_file) != os.path.getsize(source_file)
+        or os.path.getmtime(dest_file) != os.path.getmtime(source_file)
+    ):
+        shutil.copy2(source_file, dest_file)
+    return dest_file
+
+
+def stage_dir(source_dir, staging_dir):
+    """
+    Same as stage_file for a whole directory tree, also mirroring deletions
+    so files removed or renamed in the source don't linger in the bundle
+    """
+    dest_dir = os.path.join(staging_dir, os.path.basename(source_dir))
+    staged_files = set()
+    for root, _, files in os.walk(source_dir):
+        dest_sub_dir = os.path.join(dest_dir, os.path.relpath(root, source_dir))
+        for file in files:
+            staged_files.add(
+                os.path.abspath(stage_file(os.path.join(root, file), dest_sub_dir))
+            )
+    for root, dirs, files in os.walk(dest_dir, topdown=False):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if os.path.abspath(file_path) not in staged_files:
+                os.remove(file_path)
+        for dir in dirs:
+            dir_path = os.path.join(root, dir)
+            if not os.listdir(dir_path):
+                os.rmdir(dir_path)
+    return dest_dir
+
+
 def have_nuitka_commercial():
     try:
         import nuitka.plugins.commercial
@@ -242,7 +325,21 @@ def compile(arch, audience, no_gui=False):
     excludes_dir_source = os.path.join(BASEDIR, os.pardir, excludes_dir)
     excludes_dir_dest = excludes_dir
 
-    NUITKA_OPTIONS = ""
+    # Stage data files once per arch so identical content doesn't get copied
+    # again on every rebuild
+    staging_dir = os.path.join(BUILDS_DIR, ".stage", arch)
+    translations_dir_source = stage_dir(translations_dir_source, staging_dir)
+    license_source_file = stage_file(LICENSE_FILE, staging_dir)
+    restic_source_file = stage_file(restic_source_file, staging_dir)
+
+    # Persistent cache dir so Nuitka / ccache only recompile changed modules
+    # between builds
+    cache_dir = os.path.join(BUILDS_DIR, ".nuitka_cache")
+    os.environ.setdefault("NUITKA_CACHE_DIR", cache_dir)
+    os.environ.setdefault("CCACHE_DIR", os.path.join(cache_dir, "ccache"))
+
+    # Without --jobs, the C backend may compile single threaded on some platforms
+    NUITKA_OPTIONS = " --jobs={} --lto=yes".format(os.cpu_count())
     NUITKA_OPTIONS += " --enable-plugin=data-hiding" if have_nuitka_commercial() else ""
 
     # Stupid fix for synology RS816 where /tmp is mounted with `noexec`.
@@ -273,7 +370,7 @@ def compile(arch, audience, no_gui=False):
         EXE_OPTIONS,
         translations_dir_source,
         translations_dir_dest,
-        LICENSE_FILE,
+        license_source_file,
         license_dest_file,
         restic_source_file,
         restic_dest_file,
@@ -281,11 +378,9 @@ def compile(arch, audience, no_gui=False):
         OUTPUT_DIR,
     )
 
-    print(CMD)
-    errors = False
-    exit_code, output = command_runner(CMD, timeout=0, live_output=True)
-    if exit_code != 0:
-        errors = True
+    # Build commands are a list of (command, on_success) tuples which are run
+    # in order since the installer build includes the npbackup executable
+    build_commands = [(CMD, None)]
 
     # windows only installer compilation
     if os.name == "nt":
@@ -315,15 +410,58 @@ def compile(arch, audience, no_gui=False):
             OUTPUT_DIR,
         )
 
-        print(CMD)
-        exit_code, output = command_runner(CMD, timeout=0, live_output=True)
-        if exit_code != 0:
-            errors = True
-        else:
-            ## Create version file
+        def _create_version_file():
             with open(os.path.join(BUILDS_DIR, audience, "VERSION"), "w") as fh:
                 fh.write(npbackup_version)
 
+        build_commands.append((CMD, _create_version_file))
+
+    build_manifest_file = os.path.join(OUTPUT_DIR, ".build_manifest.json")
+    # Hash the exact build commands along with every source that ends up in
+    # the bundles, so option changes (eg --no-gui) and installer input changes
+    # invalidate the cache just like code changes do
+    build_manifest = {
+        "commands": [build_command for build_command, _ in build_commands],
+        "sources": get_build_manifest(
+            [
+                os.path.join(BASEDIR, os.pardir, "bin", "npbackup"),
+                os.path.join(BASEDIR, os.pardir, "bin", "NPBackupInstaller.py"),
+                BASEDIR,
+                translations_dir_source,
+                license_source_file,
+                restic_source_file,
+                dist_conf_file_source,
+                excludes_dir_source,
+            ]
+        ),
+    }
+    if os.path.isfile(program_executable_path) and os.path.isfile(build_manifest_file):
+        try:
+            with open(build_manifest_file, "r", encoding="utf-8") as file_handle:
+                if json.load(file_handle) == build_manifest:
+                    print(
+                        "Skipping {} build for arch {}: sources and options unchanged".format(
+                            audience, arch
+                        )
+                    )
+                    return True
+        except (OSError, ValueError):
+            pass
+
+    errors = False
+    for build_command, on_success in build_commands:
+        print(build_command)
+        exit_code, output = command_runner(build_command, timeout=0, live_output=True)
+        if exit_code != 0:
+            errors = True
+            break
+        if on_success:
+            on_success()
+
+    if not errors:
+        with open(build_manifest_file, "w", encoding="utf-8") as file_handle:
+            json.dump(build_manifest, file_handle)
+
     print("COMPILE ERRORS", errors)
     return not errors
 
@@ -354,6 +492,15 @@ if __name__ == "__main__":
         "--no-gui", action="store_true", default=False, help="Don't compile GUI support"
     )
 
+    parser.add_argument(
+        "--arch",
+        type=str,
+        dest="arch",
+        default=python_arch(),
+        required=False,
+        help="Comma separated list of target architectures, defaults to current python arch",
+    )
+
     args = parser.parse_args()
 
     # Make sure we get out dev environment back when compilation ends / fails
@@ -386,21 +533,31 @@ if __name__ == "__main__":
                 print("ERROR: Requested private build but no private data available")
                 errors = True
                 continue
-            result = compile(arch=python_arch(), audience=audience, no_gui=args.no_gui)
+            archs = [arch.strip() for arch in args.arch.split(",")]
             build_type = "private" if private_build else "public"
-            if result:
-                print(
-                    "SUCCESS: MADE {} build for audience {}".format(
-                        build_type, audience
-                    )
-                )
-            else:
-                print(
-                    "ERROR: Failed making {} build for audience {}".format(
-                        build_type, audience
-                    )
-                )
-                errors = True
+            # Nuitka builds are subprocesses, so a thread pool is enough to run
+            # multiple arch builds concurrently
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = {
+                    executor.submit(
+                        compile, arch=arch, audience=audience, no_gui=args.no_gui
+                    ): arch
+                    for arch in archs
+                }
+                for future, arch in futures.items():
+                    if future.result():
+                        print(
+                            "SUCCESS: MADE {} build for audience {} and arch {}".format(
+                                build_type, audience, arch
+                            )
+                        )
+                    else:
+                        print(
+                            "ERROR: Failed making {} build for audience {} and arch {}".format(
+                                build_type, audience, arch
+                            )
+                        )
+                        errors = True
         if errors:
             print("ERRORS IN BUILD PROCESS")
         else:
@@ -10,7 +10,7 @@ __license__ = "GPL-3.0-only"
 __build__ = "2023052801"
 
 
-from typing import Optional, Callable, Union, List
+from typing import Optional, Callable, Union, List, Tuple
 import os
 import logging
 import queue
@@ -453,6 +453,36 @@ class NPBackupRunner:
             logger.error("Cannot connect to repository or repository empty.")
         return result
 
+    @exec_timer
+    def list_and_check_recent_backups(self) -> Tuple[Optional[list], Optional[bool]]:
+        """
+        Returns snapshot list and recent backup state from a single restic
+        invocation, since each invocation pays the repo open cost
+        """
+        if not self.is_ready:
+            return False, None
+        logger.info("Listing snapshots")
+        snapshots = self.restic_runner.snapshots()
+        logger.info(
+            "Searching for a backup newer than {} ago.".format(
+                str(datetime.timedelta(minutes=self.minimum_backup_age))
+            )
+        )
+        if not snapshots:
+            # Keep check_recent_backups semantics: None means no repo information
+            result = None if snapshots is None else False
+        else:
+            result = self.restic_runner.has_snapshot_timedelta(
+                self.minimum_backup_age, snapshots=snapshots
+            )
+        if result:
+            logger.info("Most recent backup is from {}".format(result))
+        elif result is False:
+            logger.info("No recent backup found.")
+        elif result is None:
+            logger.error("Cannot connect to repository or repository empty.")
+        return snapshots, result
+
     @exec_timer
     def backup(self, force: bool = False) -> bool:
         """
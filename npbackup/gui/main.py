@@ -15,13 +15,14 @@ import sys
 import os
 from logging import getLogger
 import re
-import dateutil
 import queue
 from time import sleep
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Future as ConcurrentFuture
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import PySimpleGUI as sg
 from ofunctions.threading import threaded, Future
 from threading import Thread
-from ofunctions.misc import BytesConverter
 from npbackup.customization import (
     OEM_STRING,
     OEM_LOGO,
@@ -37,6 +38,7 @@ from npbackup.customization import (
     LICENSE_FILE,
 )
 from npbackup.gui.config import config_gui
+from npbackup.core.nuitka_helper import IS_COMPILED
 from npbackup.core.runner import NPBackupRunner
 from npbackup.core.i18n_helper import _t
 from npbackup.core.upgrade_runner import run_upgrade, check_new_version
@@ -48,6 +50,42 @@ logger = getLogger(__intname__)
 # There are no possible race conditions since we don't modifiy the data from anywhere outside the thread
 THREAD_SHARED_DICT = {}
 
+_SNAPSHOT_ID_REGEX = re.compile(r"\[ID ([^\]]+)\]")
+
+_BYTE_UNITS = ("B", "KiB", "MiB", "GiB", "TiB")
+
+
+def _fmt_size(size: int) -> str:
+    """
+    Cheap BytesConverter replacement since this gets called once per tree node
+    """
+    index = 0
+    while size >= 1024 and index < 4:
+        size >>= 10
+        index += 1
+    return f"{size} {_BYTE_UNITS[index]}"
+
+
+def _wait_for_threaded_result(thread, message: str, interval: float = 0.1):
+    """
+    Blocks on the future result in animation frame sized slices instead of
+    busy-waiting on thread.done(), so we only wake up to update the loader
+    """
+    try:
+        while True:
+            try:
+                return thread.result(timeout=interval)
+            except FutureTimeoutError:
+                sg.PopupAnimated(
+                    LOADER_ANIMATION,
+                    message=message,
+                    time_between_frames=int(interval * 1000),
+                    background_color=GUI_LOADER_COLOR,
+                    text_color=GUI_LOADER_TEXT_COLOR,
+                )
+    finally:
+        sg.PopupAnimated(None)
+
 
 def _about_gui(version_string: str, config_dict: dict) -> None:
     license_content = LICENSE_TEXT
@@ -108,28 +146,22 @@ def _about_gui(version_string: str, config_dict: dict) -> None:
 @threaded
 def _get_gui_data(config_dict: dict) -> Future:
     runner = NPBackupRunner(config_dict=config_dict)
-    snapshots = runner.list()
-    current_state = runner.check_recent_backups()
+    # One runner call serves both the snapshot list and the recency state, so
+    # the repo only gets opened once per refresh
+    snapshots, current_state = runner.list_and_check_recent_backups()
     snapshot_list = []
     if snapshots:
-        snapshots.reverse()  # Let's show newer snapshots first
-        for snapshot in snapshots:
-            snapshot_date = dateutil.parser.parse(snapshot["time"]).strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )
-            snapshot_username = snapshot["username"]
-            snapshot_hostname = snapshot["hostname"]
-            snapshot_id = snapshot["short_id"]
-            snapshot_list.append(
-                "{} {} {} {}@{} [ID {}]".format(
-                    _t("main_gui.backup_from"),
-                    snapshot_date,
-                    _t("main_gui.run_as"),
-                    snapshot_username,
-                    snapshot_hostname,
-                    snapshot_id,
-                )
-            )
+        # Hoist translation lookups out of the loop, _t costs a dict lookup per call
+        backup_from = _t("main_gui.backup_from")
+        run_as = _t("main_gui.run_as")
+        # restic emits fixed ISO-8601 timestamps, so a string slice gives
+        # the same result as dateutil.parser.parse + strftime for far less CPU
+        # reversed() shows newer snapshots first without copying the list
+        snapshot_list = [
+            f"{backup_from} {snapshot['time'][0:19].replace('T', ' ')} {run_as} "
+            f"{snapshot['username']}@{snapshot['hostname']} [ID {snapshot['short_id']}]"
+            for snapshot in reversed(snapshots)
+        ]
 
     return current_state, snapshot_list
 
@@ -159,16 +191,7 @@ def get_gui_data(config_dict: dict) -> Tuple[bool, List[str]]:
     # We get a thread result, hence pylint will complain the thread isn't a tuple
     # pylint: disable=E1101 (no-member)
     thread = _get_gui_data(config_dict)
-    while not thread.done() and not thread.cancelled():
-        sg.PopupAnimated(
-            LOADER_ANIMATION,
-            message=_t("main_gui.loading_data_from_repo"),
-            time_between_frames=50,
-            background_color=GUI_LOADER_COLOR,
-            text_color=GUI_LOADER_TEXT_COLOR,
-        )
-    sg.PopupAnimated(None)
-    return thread.result()
+    return _wait_for_threaded_result(thread, _t("main_gui.loading_data_from_repo"))
 
 
 def _gui_update_state(window, current_state: bool, snapshot_list: List[str]) -> None:
@@ -188,7 +211,78 @@ def _gui_update_state(window, current_state: bool, snapshot_list: List[str]) ->
 
 
 @threaded
-def _make_treedata_from_json(ls_result: List[dict]) -> sg.TreeData:
+def _ls_producer(ls_result, ls_queue: queue.Queue) -> Future:
+    """
+    Feeds restic ls output into the queue as it gets decoded, so
+    _make_treedata_from_json can consume entries concurrently
+    """
+    try:
+        for entry in ls_result:
+            ls_queue.put(entry)
+    finally:
+        # Sentinel value so the consumer knows we're done, which must also
+        # happen when iterating restic output raises, else the consumer
+        # would block forever on the queue
+        ls_queue.put(None)
+
+
+# Number of restic ls entries handed to the worker process per chunk
+_TREE_CHUNK_SIZE = 10000
+
+# Worker process for tree entry crunching, created lazily and reused across
+# windows so we only pay the spawn cost once
+# Nuitka onefile children would have to re-import this module with all its
+# import time side effects, which isn't validated for frozen builds, so the
+# offload only runs from plain python
+_TREE_EXECUTOR = None
+
+
+def _get_tree_executor() -> Optional[ProcessPoolExecutor]:
+    global _TREE_EXECUTOR
+    if IS_COMPILED:
+        return None
+    if _TREE_EXECUTOR is None:
+        _TREE_EXECUTOR = ProcessPoolExecutor(max_workers=1)
+    return _TREE_EXECUTOR
+
+
+def _ls_entries_to_nodes(entries: List[dict], casefold_paths: bool) -> List[tuple]:
+    """
+    Converts a chunk of restic ls entries into (parent, path, name, values, is_dir)
+    tuples. Pure picklable function so it can run in a worker process, icons
+    get attached by the caller since they don't need to cross the process
+    boundary
+    """
+    nodes = []
+    for entry in entries:
+        # Make sure we drop the prefix '/' so sg.TreeData does not get an empty root
+        path = entry["path"].lstrip("/")
+        # On windows, we need to make sure tree keys don't get duplicate because of lower/uppercase
+        # Shown filenames aren't affected by this
+        # The islower() pre-filter is a C scan that skips allocating a new
+        # string for the many paths that are already lowercase
+        if casefold_paths and not path.islower():
+            path = path.lower()
+        # str.rfind is a single C scan, whereas os.path.dirname pays Python
+        # call and normalization overhead once per node
+        index = path.rfind("/")
+        parent = path[:index] if index >= 0 else ""
+
+        # Make sure we normalize mtime, and remove microseconds
+        # dateutil.parser.parse is *really* cpu hungry, let's replace it with a dumb alternative
+        # mtime = dateutil.parser.parse(entry["mtime"]).strftime("%Y-%m-%d %H:%M:%S")
+        mtime = str(entry["mtime"])[0:19].replace("T", " ")
+        if entry["type"] == "dir":
+            nodes.append((parent, path, entry["name"], ["", mtime], True))
+        elif entry["type"] == "file":
+            nodes.append(
+                (parent, path, entry["name"], [_fmt_size(entry["size"]), mtime], False)
+            )
+    return nodes
+
+
+@threaded
+def _make_treedata_from_json(ls_queue: queue.Queue) -> sg.TreeData:
     """
     Treelist data construction from json input that looks like
 
@@ -202,46 +296,62 @@ def _make_treedata_from_json(ls_result: List[dict]) -> sg.TreeData:
     ]
     """
     treedata = sg.TreeData()
+    nodes = {}
     count = 0
+    casefold_paths = os.name == "nt"
     # First entry of list of list should be the snapshot description and can be discarded
     # Since we use an iter now, first result was discarded by ls_window function already
     # ls_result.pop(0)
-    for entry in ls_result:
-        # Make sure we drop the prefix '/' so sg.TreeData does not get an empty root
-        entry["path"] = entry["path"].lstrip("/")
-        if os.name == "nt":
-            # On windows, we need to make sure tree keys don't get duplicate because of lower/uppercase
-            # Shown filenames aren't affected by this
-            entry["path"] = entry["path"].lower()
-        parent = os.path.dirname(entry["path"])
 
-        # Make sure we normalize mtime, and remove microseconds
-        # dateutil.parser.parse is *really* cpu hungry, let's replace it with a dumb alternative
-        # mtime = dateutil.parser.parse(entry["mtime"]).strftime("%Y-%m-%d %H:%M:%S")
-        mtime = str(entry["mtime"])[0:19]
-        if entry["type"] == "dir" and entry["path"] not in treedata.tree_dict:
-            treedata.Insert(
-                parent=parent,
-                key=entry["path"],
-                text=entry["name"],
-                values=["", mtime],
-                icon=FOLDER_ICON,
-            )
-        elif entry["type"] == "file":
-            size = BytesConverter(entry["size"]).human
-            treedata.Insert(
-                parent=parent,
-                key=entry["path"],
-                text=entry["name"],
-                values=[size, mtime],
-                icon=FILE_ICON,
-            )
-        # Since the thread is heavily CPU bound, let's add a minimal
-        # arbitrary sleep time to let GUI update
-        # In a 130k entry scenario, this added less than a second on a 25 second run
-        count += 1
-        if not count % 1000:
-            sleep(0.0001)
+    # The per entry string crunching is pure CPU and GIL bound, so chunks get
+    # handed to a worker process while this thread keeps draining restic output
+    # In frozen builds there is no executor and chunks get crunched in-thread
+    executor = _get_tree_executor()
+
+    def _crunch(chunk):
+        if executor:
+            return executor.submit(_ls_entries_to_nodes, chunk, casefold_paths)
+        return _ls_entries_to_nodes(chunk, casefold_paths)
+
+    node_batches = []
+    chunk = []
+    while True:
+        entry = ls_queue.get()
+        if entry is None:
+            break
+        chunk.append(entry)
+        if len(chunk) >= _TREE_CHUNK_SIZE:
+            node_batches.append(_crunch(chunk))
+            chunk = []
+    if chunk:
+        node_batches.append(_crunch(chunk))
+
+    # Batches are merged in submission order so directory dedup via
+    # setdefault behaves exactly like the former sequential loop
+    for batch in node_batches:
+        if isinstance(batch, ConcurrentFuture):
+            batch = batch.result()
+        for parent, path, name, values, is_dir in batch:
+            if is_dir:
+                nodes.setdefault(path, (parent, path, name, values, FOLDER_ICON))
+            else:
+                nodes[path] = (parent, path, name, values, FILE_ICON)
+            # Since the thread is heavily CPU bound, let's add a minimal
+            # arbitrary sleep time to let GUI update
+            count += 1
+            if not count % 1000:
+                sleep(0.0001)
+
+    # Build nodes directly instead of going through sg.TreeData.Insert, which
+    # pays a lookup and icon handling tax per call
+    # Sorting keys by depth guarantees parents exist before children get attached
+    tree_dict = treedata.tree_dict
+    for parent, key, text, values, icon in sorted(
+        nodes.values(), key=lambda node: node[1].count("/")
+    ):
+        node = sg.TreeData.Node(parent, key, text, values, icon)
+        tree_dict[key] = node
+        tree_dict[parent].children.append(node)
     return treedata
 
 
@@ -266,7 +376,8 @@ def _ls_window(config: dict, snapshot_id: str) -> Future:
     except StopIteration:
         return None, None
     try:
-        snap_date = dateutil.parser.parse(snapshot_id["time"])
+        # restic timestamps are strict ISO-8601, no need for dateutil here
+        snap_date = snapshot_id["time"][0:19].replace("T", " ")
     except (KeyError, IndexError):
         snap_date = "[inconnu]"
     try:
@@ -282,67 +393,40 @@ def _ls_window(config: dict, snapshot_id: str) -> Future:
     except (KeyError, IndexError):
         hostname = "[inconnu]"
 
-    backup_content = " {} {} {} {}@{} {} {}".format(
-        _t("main_gui.backup_content_from"),
-        snap_date,
-        _t("main_gui.run_as"),
-        username,
-        hostname,
-        _t("main_gui.identified_by"),
-        short_id,
+    backup_content = (
+        f" {_t('main_gui.backup_content_from')} {snap_date} {_t('main_gui.run_as')} "
+        f"{username}@{hostname} {_t('main_gui.identified_by')} {short_id}"
     )
     return backup_content, result
 
 
 def delete_backup(config: dict, snapshot: str) -> bool:
-    snapshot_id = re.match(r".*\[ID (.*)\].*", snapshot).group(1)
+    snapshot_id = _SNAPSHOT_ID_REGEX.search(snapshot).group(1)
     # We get a thread result, hence pylint will complain the thread isn't a tuple
     # pylint: disable=E1101 (no-member)
     thread = _delete_backup(config, snapshot_id)
 
-    while not thread.done() and not thread.cancelled():
-        sg.PopupAnimated(
-            LOADER_ANIMATION,
-            message="{}. {}".format(
-                _t("main_gui.execute_operation"),
-                _t("main_gui.this_will_take_a_while"),
-            ),
-            time_between_frames=50,
-            background_color=GUI_LOADER_COLOR,
-            text_color=GUI_LOADER_TEXT_COLOR,
-        )
-    sg.PopupAnimated(None)
-    result = thread.result()
+    result = _wait_for_threaded_result(
+        thread,
+        f"{_t('main_gui.execute_operation')}. {_t('main_gui.this_will_take_a_while')}",
+    )
     if not result:
         sg.PopupError(_t("main_gui.delete_failed"), keep_on_top=True)
         return False
     else:
-        sg.Popup(
-            "{} {} {}".format(
-                snapshot, _t("generic.deleted"), _t("generic.successfully")
-            )
-        )
+        sg.Popup(f"{snapshot} {_t('generic.deleted')} {_t('generic.successfully')}")
 
 
 def ls_window(config: dict, snapshot: str) -> bool:
-    snapshot_id = re.match(r".*\[ID (.*)\].*", snapshot).group(1)
+    snapshot_id = _SNAPSHOT_ID_REGEX.search(snapshot).group(1)
     # We get a thread result, hence pylint will complain the thread isn't a tuple
     # pylint: disable=E1101 (no-member)
     thread = _ls_window(config, snapshot_id)
 
-    while not thread.done() and not thread.cancelled():
-        sg.PopupAnimated(
-            LOADER_ANIMATION,
-            message="{}. {}".format(
-                _t("main_gui.loading_data_from_repo"),
-                _t("main_gui.this_will_take_a_while"),
-            ),
-            time_between_frames=50,
-            background_color=GUI_LOADER_COLOR,
-            text_color=GUI_LOADER_TEXT_COLOR,
-        )
-    sg.PopupAnimated(None)
-    backup_content, ls_result = thread.result()
+    backup_content, ls_result = _wait_for_threaded_result(
+        thread,
+        f"{_t('main_gui.loading_data_from_repo')}. {_t('main_gui.this_will_take_a_while')}",
+    )
     if not backup_content or not ls_result:
         sg.PopupError(_t("main_gui.cannot_get_content"), keep_on_top=True)
         return False
@@ -351,20 +435,16 @@ def ls_window(config: dict, snapshot: str) -> bool:
     # In the thread, we added a sleep argument every 1000 iters so we get to update
     # the GUI. Earlier fix was to preload animation
 
+    # Stream restic ls output into the tree builder via a queue so JSON
+    # decoding and node construction overlap instead of running sequentially
+
     # We get a thread result, hence pylint will complain the thread isn't a tuple
     # pylint: disable=E1101 (no-member)
-    thread = _make_treedata_from_json(ls_result)
-
-    while not thread.done() and not thread.cancelled():
-        sg.PopupAnimated(
-            LOADER_ANIMATION,
-            message="{}...".format(_t("main_gui.creating_tree")),
-            time_between_frames=50,
-            background_color=GUI_LOADER_COLOR,
-            text_color=GUI_LOADER_TEXT_COLOR,
-        )
-    sg.PopupAnimated(None)
-    treedata = thread.result()
+    ls_queue = queue.Queue()
+    _ls_producer(ls_result, ls_queue)
+    thread = _make_treedata_from_json(ls_queue)
+
+    treedata = _wait_for_threaded_result(thread, f"{_t('main_gui.creating_tree')}...")
 
     left_col = [
         [sg.Text(backup_content)],
@@ -458,17 +538,9 @@ def restore_window(
                 target=values["-RESTORE-FOLDER-"],
                 restore_includes=restore_include,
             )
-            while not thread.done() and not thread.cancelled():
-                sg.PopupAnimated(
-                    LOADER_ANIMATION,
-                    message="{}...".format(_t("main_gui.restore_in_progress")),
-                    time_between_frames=50,
-                    background_color=GUI_LOADER_COLOR,
-                    text_color=GUI_LOADER_TEXT_COLOR,
-                )
-            sg.PopupAnimated(None)
-
-            result = thread.result()
+            result = _wait_for_threaded_result(
+                thread, f"{_t('main_gui.restore_in_progress')}..."
+            )
             try:
                 exec_time = THREAD_SHARED_DICT["exec_time"]
             except KeyError:
@@ -485,6 +557,25 @@ def restore_window(
     window.close()
 
 
+def _snapshot_refresher(gui_context: dict, window: sg.Window) -> None:
+    """
+    Periodically fetches repo state in the background and pushes the result
+    to the main event loop, so the GUI doesn't have to run restic on a
+    read timeout
+
+    gui_context is shared with the event loop so configuration changes apply
+    to subsequent fetches, and results get tagged with the refresh generation
+    so the event loop can drop data made stale by a foreground refresh
+    """
+    while True:
+        sleep(60)
+        generation = gui_context["refresh_generation"]
+        # We get a thread result, hence pylint will complain the thread isn't a tuple
+        # pylint: disable=E1101 (no-member)
+        result = _get_gui_data(gui_context["config_dict"]).result()
+        window.write_event_value("refresh", (generation, result))
+
+
 @threaded
 def _gui_backup(config_dict, stdout) -> Future:
     runner = NPBackupRunner(config_dict=config_dict)
@@ -514,9 +605,7 @@ def main_gui(config_dict: dict, config_file: str, version_string: str):
             "GZ",
             "RCLONE",
         ]:
-            backup_destination = "{} {}".format(
-                _t("main_gui.external_server"), backend_type
-            )
+            backup_destination = f"{_t('main_gui.external_server')} {backend_type}"
     except (KeyError, AttributeError, TypeError):
         pass
 
@@ -533,7 +622,7 @@ def main_gui(config_dict: dict, config_file: str, version_string: str):
                         sg.Column(
                             [
                                 [sg.Text(OEM_STRING, font="Arial 14")],
-                                [sg.Text("{}: ".format(_t("main_gui.backup_state")))],
+                                [sg.Text(f"{_t('main_gui.backup_state')}: ")],
                                 [
                                     sg.Button(
                                         _t("generic.unknown"),
@@ -547,13 +636,7 @@ def main_gui(config_dict: dict, config_file: str, version_string: str):
                             vertical_alignment="top",
                         ),
                     ],
-                    [
-                        sg.Text(
-                            "{} {}".format(
-                                _t("main_gui.backup_list_to"), backup_destination
-                            )
-                        )
-                    ],
+                    [sg.Text(f"{_t('main_gui.backup_list_to')} {backup_destination}")],
                     [sg.Listbox(values=[], key="snapshot-list", size=(80, 15))],
                     [
                         sg.Button(_t("main_gui.launch_backup"), key="launch-backup"),
@@ -588,11 +671,24 @@ def main_gui(config_dict: dict, config_file: str, version_string: str):
     window.read(timeout=1)
     current_state, snapshot_list = get_gui_data(config_dict)
     _gui_update_state(window, current_state, snapshot_list)
+    # Shared with the refresher thread so it always sees the current config
+    # and can detect foreground refreshes that make its data stale
+    gui_context = {"config_dict": config_dict, "refresh_generation": 0}
+    Thread(target=_snapshot_refresher, args=(gui_context, window), daemon=True).start()
     while True:
-        event, values = window.read(timeout=60000)
+        event, values = window.read()
 
+        # Only events that actually change repo state should re-run restic
+        refresh_needed = False
         if event in (sg.WIN_CLOSED, "exit"):
             break
+        if event == "refresh":
+            generation, (current_state, snapshot_list) = values["refresh"]
+            # Drop background data fetched before the last foreground
+            # refresh, else it would revert the window to pre-operation state
+            if generation == gui_context["refresh_generation"]:
+                _gui_update_state(window, current_state, snapshot_list)
+            continue
         if event == "launch-backup":
             progress_windows_layout = [
                 [
@@ -614,27 +710,46 @@ def main_gui(config_dict: dict, config_file: str, version_string: str):
             # We get a thread result, hence pylint will complain the thread isn't a tuple
             # pylint: disable=E1101 (no-member)
             thread = _gui_backup(config_dict=config_dict, stdout=stdout)
-            while not thread.done() and not thread.cancelled():
+            while True:
                 try:
-                    stdout_line = stdout.get(timeout=0.01)
-                except queue.Empty:
-                    pass
-                else:
+                    result = thread.result(timeout=0.2)
+                    backup_done = True
+                except FutureTimeoutError:
+                    backup_done = False
+                # Drain all available output lines in one batch so the
+                # progress window gets updated once per frame instead of once
+                # per line, which capped throughput on chatty restic runs
+                lines = []
+                while True:
+                    try:
+                        stdout_line = stdout.get_nowait()
+                    except queue.Empty:
+                        break
                     if stdout_line:
-                        progress_window["progress"].Update(stdout_line)
+                        lines.append(stdout_line)
+                if lines:
+                    # Normalize line endings before joining since append adds
+                    # no separator itself; this keeps exactly one newline per
+                    # line whether or not command_runner enqueues trailing ones
+                    progress_window["progress"].Update(
+                        "\n".join(line.rstrip("\r\n") for line in lines) + "\n",
+                        append=True,
+                    )
+                if backup_done:
+                    break
                 sg.PopupAnimated(
                     LOADER_ANIMATION,
-                    message="{}...".format(_t("main_gui.backup_in_progress")),
-                    time_between_frames=50,
+                    message=f"{_t('main_gui.backup_in_progress')}...",
+                    time_between_frames=200,
                     background_color=GUI_LOADER_COLOR,
                     text_color=GUI_LOADER_TEXT_COLOR,
                 )
             sg.PopupAnimated(None)
-            result = thread.result()
             try:
                 exec_time = THREAD_SHARED_DICT["exec_time"]
             except KeyError:
                 exec_time = "N/A"
+            gui_context["refresh_generation"] += 1
             current_state, snapshot_list = get_gui_data(config_dict)
             _gui_update_state(window, current_state, snapshot_list)
             if not result:
@@ -658,11 +773,13 @@ def main_gui(config_dict: dict, config_file: str, version_string: str):
                 continue
             delete_backup(config_dict, snapshot=values["snapshot-list"][0])
             # Make sure we trigger a GUI refresh after deletions
-            event = "state-button"
+            refresh_needed = True
         if event == "configure":
             config_dict = config_gui(config_dict, config_file)
+            # Make sure the refresher thread sees the new configuration too
+            gui_context["config_dict"] = config_dict
             # Make sure we trigger a GUI refresh when configuration is changed
-            event = "state-button"
+            refresh_needed = True
         if event == _t("generic.destination"):
             try:
                 if backend_type:
@@ -678,6 +795,9 @@ def main_gui(config_dict: dict, config_file: str, version_string: str):
         if event == "about":
             _about_gui(version_string, config_dict)
         if event == "state-button":
+            refresh_needed = True
+        if refresh_needed:
+            gui_context["refresh_generation"] += 1
             current_state, snapshot_list = get_gui_data(config_dict)
             _gui_update_state(window, current_state, snapshot_list)
             if current_state is None:
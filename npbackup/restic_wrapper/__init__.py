@@ -680,20 +680,26 @@ class ResticRunner:
         logger.critical("Raw command failed.")
         return False, output
 
-    def has_snapshot_timedelta(self, delta: int = 1441) -> Optional[datetime]:
+    def has_snapshot_timedelta(
+        self, delta: int = 1441, snapshots: Optional[list] = None
+    ) -> Optional[datetime]:
         """
         Checks if a snapshot exists that is newer that delta minutes
         Eg: if delta = -60 we expect a snapshot newer than an hour ago, and return True if exists
             if delta = +60 we expect a snpashot newer than one hour in future (!), and return True if exists
             returns False is too old snapshots exit
             returns None if no info available
+
+        An already fetched snapshot list can be given to avoid running restic
+        again, since opening the repo is by far the slowest step
         """
         if not self.is_init:
             return None
         try:
-            snapshots = self.snapshots()
-            if self.last_command_status is False:
-                return None
+            if snapshots is None:
+                snapshots = self.snapshots()
+                if self.last_command_status is False:
+                    return None
             if not snapshots:
                 return False
 